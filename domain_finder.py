@@ -1,12 +1,28 @@
 import pandas as pd
-import requests
+import aiohttp
+import orjson
+import asyncio
+import argparse
+import sqlite3
 import time
 import os
+import random
+import re
+import socket
+from dataclasses import dataclass, field
+from typing import Optional
 from urllib.parse import urlparse 
 
+try:
+    import aiodns  # Optional: lets aiohttp resolve DNS asynchronously.
+except ImportError:
+    aiodns = None
+
 
 INPUT_CSV_FILE = 'Companies_181876.csv' 
 OUTPUT_CSV_FILE = 'companies_with_domains_lusha_batch.csv' 
+CACHE_DB_FILE = 'lusha_cache.sqlite' 
+CHECKPOINT_FILE = 'checkpoint.txt' 
 
 # Column names in CSV:
 COMPANY_NAME_COLUMN = 'Organization - Name' 
@@ -28,21 +44,225 @@ if LUSHA_API_KEY is None:
         exit()
 
 # --- Batching, Rate Limiting, and Retry Settings ---
-BATCH_SIZE = 50            
-REQUEST_DELAY_SECONDS = 2.0 
+BATCH_SIZE = 50            # Starting size; adapted while running (see AdaptiveBatchSize).
+MIN_BATCH_SIZE = 10        
+MAX_BATCH_SIZE = 200       
+BATCH_SIZE_STEP = 10       
 MAX_RETRIES = 3             
-RETRY_DELAY_SECONDS = 15    
+RETRY_BACKOFF_BASE_SECONDS = 2  
+RETRY_BACKOFF_CAP_SECONDS = 60  
+MAX_CONCURRENT_BATCHES = 8  
+CONNECTION_POOL_LIMIT = 16  
+CONNECTION_KEEPALIVE_SECONDS = 60 
+DNS_CACHE_TTL_SECONDS = 300 
+
+# --- Token Bucket Pacing (1 token = 1 company sent to Lusha) ---
+# Tune these to the quota of your Lusha plan.
+TOKEN_BUCKET_CAPACITY = BATCH_SIZE * MAX_CONCURRENT_BATCHES 
+TOKEN_BUCKET_REFILL_RATE = 25.0  # tokens per second
+
+# --- Domain Cache Settings ---
+CACHE_LOOKUP_CHUNK_SIZE = 500 
+
+# --- Streaming Settings ---
+CSV_CHUNK_SIZE = 10000     # Rows read, looked up and written (then checkpointed) at a time.
+
+LUSHA_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=20)
+
+# Host part of a website URL, with or without the http(s):// prefix.
+# Anything else starting with 'scheme:' (ftp://, mailto:, a malformed http:/) doesn't
+# match and is left to urlparse; 'host:8080' still matches as a port.
+_NETLOC_RE = re.compile(r'^(?:https?://)?(?![a-z][a-z0-9+.-]*:(?!\d))([^/?#]+)', re.IGNORECASE)
+
+
+@dataclass
+class BatchResult:
+    """What one batch request produced, including the quota headers Lusha sent back."""
+    results: dict = field(default_factory=dict)
+    daily_limit: Optional[int] = None
+    daily_left: Optional[int] = None
+    error: Optional[str] = None
+    throttled: bool = False
+
+    def fail(self, error):
+        """Marks the batch as failed with `error` and returns it."""
+        self.error = error
+        return self
+
+
+class Quota:
+    """
+    The single shared view of the Lusha daily quota and of critical errors.
+
+    Batches report back through `record`, which holds a lock so concurrent
+    batches never interleave their updates.
+    """
+
+    def __init__(self):
+        self.daily_limit = "N/A"
+        self.daily_left = "N/A"
+        self.critical_error = None
+        self._lock = asyncio.Lock()
+
+    def exhausted(self):
+        """Returns True once Lusha reports that no daily requests are left."""
+        return isinstance(self.daily_left, int) and self.daily_left <= 0
+
+    def should_stop(self):
+        """Returns True when no further batches should be sent."""
+        return self.critical_error is not None or self.exhausted()
+
+    async def record(self, batch_result):
+        """Folds the quota headers and error of a finished batch into the shared state."""
+        async with self._lock:
+            if batch_result.daily_limit is not None:
+                self.daily_limit = batch_result.daily_limit
+            if batch_result.daily_left is not None:
+                # Batches can finish out of order; never let an older, higher count win.
+                if isinstance(self.daily_left, int) and isinstance(batch_result.daily_left, int):
+                    self.daily_left = min(self.daily_left, batch_result.daily_left)
+                else:
+                    self.daily_left = batch_result.daily_left
+            if batch_result.error is not None and self.critical_error is None:
+                self.critical_error = batch_result.error
+
+
+lusha_quota = Quota()
+
+# Domains resolved during this run, keyed by normalized company name.
+domain_memo = {}
+
+
+class TokenBucket:
+    """
+    Paces requests to a steady rate while still allowing short bursts.
+
+    Tokens refill continuously at `refill_rate` per second up to `capacity`.
+    A request for more tokens than are available is granted immediately, and the
+    caller is told how long to wait so the bucket is back at zero afterwards.
+    """
+
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def acquire(self, n):
+        """
+        Takes `n` tokens from the bucket.
+
+        Args:
+            n (int): The number of tokens needed (companies in the batch).
+
+        Returns:
+            float: Seconds the caller should wait before sending the request.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+        delay = 0.0
+        if self.tokens < n:
+            delay = (n - self.tokens) / self.refill_rate
+        self.tokens -= n
+        return delay
+
+    def penalize(self):
+        """Drains the bucket after a 429 so pacing resyncs with the server."""
+        self.tokens = min(self.tokens - self.refill_rate, -1)
+
+
+lusha_token_bucket = TokenBucket(TOKEN_BUCKET_CAPACITY, TOKEN_BUCKET_REFILL_RATE)
+
+
+class AdaptiveBatchSize:
+    """
+    Tunes the batch size with additive increase / multiplicative decrease.
+
+    Every clean batch adds `step` companies (up to `maximum`); a 429 or a
+    timeout halves the size (down to `minimum`).
+    """
+
+    def __init__(self, initial, minimum, maximum, step):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+
+    def grow(self):
+        self.size = min(self.maximum, self.size + self.step)
+
+    def shrink(self):
+        self.size = max(self.minimum, self.size // 2)
+
+
+lusha_batch_size = AdaptiveBatchSize(BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE, BATCH_SIZE_STEP)
+
+arg_parser = argparse.ArgumentParser(description="Find company domains with the Lusha batch API.")
+arg_parser.add_argument('--rebuild', action='store_true',
+                        help="Ignore cached domains and query Lusha again for every company (the cache is refreshed).")
+args = arg_parser.parse_args()
+
+# --- Local domain cache (normalized company name -> domain) ---
+cache_conn = sqlite3.connect(CACHE_DB_FILE)
+cache_conn.execute("CREATE TABLE IF NOT EXISTS cache (name_key TEXT PRIMARY KEY, domain TEXT, ts INTEGER)")
+cache_conn.commit()
+
+
+def normalize_company_name(company_name):
+    """Returns the cache key for a company name."""
+    return str(company_name).lower().strip()
+
+
+def load_cached_domains(name_keys):
+    """
+    Looks up previously found domains in the local cache.
+
+    Args:
+        name_keys (list): Normalized company names to look up.
+
+    Returns:
+        dict: A dictionary mapping each cached name key to its domain.
+    """
+    cached_domains = {}
+    for start in range(0, len(name_keys), CACHE_LOOKUP_CHUNK_SIZE):
+        chunk = name_keys[start:start + CACHE_LOOKUP_CHUNK_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        rows = cache_conn.execute(f"SELECT name_key, domain FROM cache WHERE name_key IN ({placeholders})", chunk)
+        cached_domains.update(rows)
+    return cached_domains
+
+
+def is_cacheable(domain):
+    """Returns False for results that must be retried later instead of being remembered."""
+    return domain != "API_RESPONSE_EMPTY_DATA"
+
+
+def save_domains_to_cache(companies_batch_data, results):
+    """
+    Stores the domains Lusha returned for a batch in the local cache.
+
+    Args:
+        companies_batch_data (tuple): Aligned arrays (client_ids, company_names, pandas_indices) for the batch.
+        results (dict): The batch results, mapping pandas_index to found domain.
+    """
+    now = int(time.time())
+    rows = [
+        (normalize_company_name(company_name), results[pandas_index], now)
+        for company_name, pandas_index in zip(companies_batch_data[1], companies_batch_data[2])
+        if pandas_index in results and is_cacheable(results[pandas_index])
+    ]
+    if rows:
+        cache_conn.executemany("INSERT OR REPLACE INTO cache VALUES (?,?,?)", rows)
+        cache_conn.commit()
 
-# --- Global Rate Limit Tracking Variables ---
-lusha_daily_limit = "N/A"
-lusha_daily_requests_left = "N/A"
 
 print(f"Starting domain lookup for companies from: {INPUT_CSV_FILE}")
 
-# --- Step 1: Load the CSV file ---
+# --- Step 1: Read the CSV header ---
 try:
-    df = pd.read_csv(INPUT_CSV_FILE)
-    print(f"Successfully loaded {len(df)} companies.")
+    input_columns = pd.read_csv(INPUT_CSV_FILE, nrows=0).columns
 except FileNotFoundError:
     print(f"Error: The file '{INPUT_CSV_FILE}' was not found. Please ensure it's in the same folder as this script.")
     exit()
@@ -50,200 +270,483 @@ except Exception as e:
     print(f"An error occurred while reading the CSV: {e}")
     exit()
 
-# --- Step 2: Prepare the DataFrame ---
-if COMPANY_NAME_COLUMN not in df.columns:
+# --- Step 2: Check the columns ---
+if COMPANY_NAME_COLUMN not in input_columns:
     print(f"Error: '{COMPANY_NAME_COLUMN}' column not found. Please check your CSV header.")
-    print("Existing columns are:", df.columns.tolist())
+    print("Existing columns are:", input_columns.tolist())
     exit()
 
-if CLIENT_COMPANY_ID_COLUMN not in df.columns:
+if CLIENT_COMPANY_ID_COLUMN not in input_columns:
     print(f"Error: '{CLIENT_COMPANY_ID_COLUMN}' column not found. Please check your CSV header.")
-    print("Existing columns are:", df.columns.tolist())
+    print("Existing columns are:", input_columns.tolist())
     exit()
 
-if DOMAIN_COLUMN not in df.columns:
-    df[DOMAIN_COLUMN] = '' 
-    print(f"Added new column '{DOMAIN_COLUMN}' to store found domains.")
+if DOMAIN_COLUMN not in input_columns:
+    print(f"Adding new column '{DOMAIN_COLUMN}' to store found domains.")
 else:
     print(f"Using existing column '{DOMAIN_COLUMN}' for domains.")
 
-df[DOMAIN_COLUMN] = df[DOMAIN_COLUMN].astype(str).replace('nan', '')
+if args.rebuild:
+    print("Rebuild requested: ignoring the local domain cache.")
+
+# The lookup columns are read as strings so Client IDs are sent exactly as written.
+lookup_dtypes = {column: 'string' for column in (COMPANY_NAME_COLUMN, CLIENT_COMPANY_ID_COLUMN, DOMAIN_COLUMN)
+                 if column in input_columns}
+
+
+def _netloc(website):
+    """Returns the host part of a website URL, or '' if it has none."""
+    website = website.strip()
+    netloc_match = _NETLOC_RE.match(website)
+    if netloc_match:
+        return netloc_match.group(1)
+    return urlparse(website).netloc
+
+
+def parse_company_domain(company_data):
+    """
+    Picks the domain out of one company entry of a Lusha batch response.
+
+    Prefers 'fqdn', then 'domain', then the host of 'website'.
+
+    Args:
+        company_data (dict): The value Lusha returned for one requested company.
+
+    Returns:
+        str: The domain, or a "Not Found ..." / "No Domain in Website URL" marker.
+    """
+    if not isinstance(company_data, dict):
+        return "Not Found"
+    if company_data.get('code') == 3 and company_data.get('name') == 'EMPTY_DATA':
+        return "Not Found (Lusha Empty Data)"
+
+    found_domain = company_data.get('fqdn') or company_data.get('domain')
+    if found_domain:
+        return found_domain
+    website = company_data.get('website')
+    if website:
+        return _netloc(website) or "No Domain in Website URL"
+    return "Not Found"
+
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Returns how long to wait before retrying a failed batch request.
+
+    A numeric Retry-After header from Lusha wins (clamped to
+    [0, RETRY_BACKOFF_CAP_SECONDS]); otherwise this is capped exponential
+    backoff with full jitter.
+
+    Args:
+        attempt (int): The zero-based number of the attempt that just failed.
+        retry_after (str): The Retry-After header of the response, if any.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), RETRY_BACKOFF_CAP_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_BACKOFF_CAP_SECONDS, RETRY_BACKOFF_BASE_SECONDS * (2 ** attempt)))
 
 
 # --- Function to call Lusha Batch API ---
-def get_domains_from_lusha_batch(companies_batch_data, api_key, url):
+async def get_domains_from_lusha_batch(session, companies_batch_data, url):
     """
     Makes a batch POST request to the Lusha API to find company domains.
 
+    Companies already resolved earlier in the run are answered from `domain_memo`
+    without being sent. The outcome also feeds `lusha_batch_size`: a clean batch
+    grows the next batches, a throttled one shrinks them.
+
     Args:
-        companies_batch_data (list): A list of tuples, each containing (client_id, company_name, pandas_index).
-        api_key (str): Your Lusha API key.
+        session (aiohttp.ClientSession): Shared session holding the connection pool and the Lusha headers.
+        companies_batch_data (tuple): Aligned arrays (client_ids, company_names, pandas_indices) for the batch.
+                                      IDs and names must already be validated and stripped.
         url (str): The Lusha batch API endpoint URL.
 
     Returns:
-        dict: A dictionary mapping original pandas_index to found domain or an error string.
-              Returns {"error": "ERROR_MESSAGE"} on critical failures.
+        BatchResult: `results` maps original pandas_index to found domain;
+                     `error` is set on critical failures.
     """
-    global lusha_daily_limit, lusha_daily_requests_left 
+    client_ids, company_names, pandas_indices = companies_batch_data
+    name_keys = [normalize_company_name(company_name) for company_name in company_names]
 
-    headers = {
-        'api_key': api_key, 
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
+    memo_results = {
+        pandas_index: domain_memo[name_key]
+        for name_key, pandas_index in zip(name_keys, pandas_indices)
+        if name_key in domain_memo
     }
-
     request_body = {
-        "companies": []
+        "companies": [
+            {"id": client_id, "name": company_name}
+            for client_id, company_name, name_key in zip(client_ids, company_names, name_keys)
+            if name_key not in domain_memo
+        ]
     }
-    id_to_pandas_index_map = {}
-
-    for client_id, company_name, pandas_index in companies_batch_data:
-        if pd.isna(client_id) or str(client_id).strip() == '':
-            print(f"  > Skipping company due to missing Client ID at pandas index {pandas_index}.")
-            continue
-        if company_name and str(company_name).strip() != '':
-            lusha_id = str(client_id).strip()
-            request_body["companies"].append({
-                "id": lusha_id,
-                "name": str(company_name).strip()
-            })
-            id_to_pandas_index_map[lusha_id] = pandas_index
-        else:
-            print(f"  > Skipping empty company name in batch for Client ID: {client_id}")
+    id_to_pandas_index_map = dict(zip(client_ids, pandas_indices))
 
     if not request_body["companies"]:
-        print("  > No valid companies to process in this batch.")
-        return {}
+        return BatchResult(results=memo_results)
 
     print(f"  > Sending batch of {len(request_body['companies'])} companies to Lusha API...")
+    batch_result = await post_lusha_batch(session, request_body, id_to_pandas_index_map, companies_batch_data, url)
+    await lusha_quota.record(batch_result)
 
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = requests.post(url, headers=headers, json=request_body, timeout=20)
-
-            # --- Extract and update rate limit headers ---
-            lusha_daily_limit = response.headers.get('x-rate-limit-daily', lusha_daily_limit)
-            lusha_daily_requests_left = response.headers.get('x-daily-requests-left', lusha_daily_requests_left)
-            
-            try:
-                lusha_daily_limit = int(lusha_daily_limit)
-            except ValueError:
-                pass
-            try:
-                lusha_daily_requests_left = int(lusha_daily_requests_left)
-            except ValueError:
-                pass
-            # --- End rate limit header extraction ---
-
-            if response.status_code in [200, 201]:
-                try:
-                    data = response.json()
-                except requests.exceptions.JSONDecodeError as e:
-                    print(f"  > CRITICAL JSON ERROR: Could not decode JSON from response: {e}")
-                    print(f"  > Full Response Text (for debugging): {response.text}")
-                    return {"error": "JSON_DECODE_ERROR"}
-
-                results = {}
-                if data:
-                    for returned_lusha_id, company_data_from_lusha in data.items():
-                        found_domain = "Not Found"
-
-                        if isinstance(company_data_from_lusha, dict) and company_data_from_lusha.get('code') == 3 and company_data_from_lusha.get('name') == 'EMPTY_DATA':
-                            found_domain = "Not Found (Lusha Empty Data)"
-                        elif isinstance(company_data_from_lusha, dict):
-                            if 'fqdn' in company_data_from_lusha and company_data_from_lusha['fqdn']:
-                                found_domain = company_data_from_lusha['fqdn']
-                            elif 'domain' in company_data_from_lusha and company_data_from_lusha['domain']:
-                                found_domain = company_data_from_lusha['domain']
-                            elif 'website' in company_data_from_lusha and company_data_from_lusha['website']:
-                                parsed_url = urlparse(company_data_from_lusha['website'])
-                                if parsed_url.netloc:
-                                    found_domain = parsed_url.netloc
-                                else:
-                                    found_domain = "No Domain in Website URL"
-
-                        if returned_lusha_id and returned_lusha_id in id_to_pandas_index_map:
-                            original_pandas_index = id_to_pandas_index_map[returned_lusha_id]
-                            results[original_pandas_index] = found_domain
-                        else:
-                            print(f"  > Warning: Lusha returned an ID '{returned_lusha_id}' not found in our original batch map.")
-                else:
-                    print(f"  > Warning: Lusha returned an empty data object for a {response.status_code} response.")
-                    for client_id, _, pandas_index in companies_batch_data:
-                        results[pandas_index] = "API_RESPONSE_EMPTY_DATA"
+    if batch_result.throttled:
+        lusha_batch_size.shrink()
+    elif batch_result.error is None:
+        lusha_batch_size.grow()
 
-                return results
+    if batch_result.error is not None:
+        return batch_result
 
-            elif response.status_code == 429:
-                print(f"  > Rate limit hit. Retrying in {RETRY_DELAY_SECONDS} seconds (Attempt {attempt + 1}/{MAX_RETRIES})...")
-                time.sleep(RETRY_DELAY_SECONDS)
-                continue
+    results = batch_result.results
+    save_domains_to_cache(companies_batch_data, results)
+    for name_key, pandas_index in zip(name_keys, pandas_indices):
+        if pandas_index in results and is_cacheable(results[pandas_index]):
+            domain_memo[name_key] = results[pandas_index]
+
+    results.update(memo_results)
+    print(f"  > Current Lusha Daily Limit: {lusha_quota.daily_limit}, Requests Left: {lusha_quota.daily_left}")
+    return batch_result
 
-            elif response.status_code == 401:
-                print(f"  > Unauthorized (401). Check your Lusha API key. Critical error, exiting batch processing.")
-                return {"error": "AUTH_ERROR"}
-
-            else: # Catch any other non-success status codes, like 403
-                print(f"  > API error for batch: Status {response.status_code}, Response: {response.text}")
-                
-                if "Lusha FireWall" in response.text:
-                    print("  > Lusha FireWall blocked access. This is likely due to rate limits or account restrictions.")
-                    return {"error": "LUSHA_FIREWALL_BLOCK"}
-                return {"error": f"API_ERROR_STATUS_{response.status_code}"}
-
-        except requests.exceptions.Timeout:
-            print(f"  > Request timed out for batch. Retrying (Attempt {attempt + 1}/{MAX_RETRIES})...")
-            time.sleep(RETRY_DELAY_SECONDS)
-        except requests.exceptions.RequestException as e:
-            print(f"  > Network or request error for batch: {e}. Retrying (Attempt {attempt + 1}/{MAX_RETRIES})...")
-            time.sleep(RETRY_DELAY_SECONDS)
+
+async def post_lusha_batch(session, request_body, id_to_pandas_index_map, companies_batch_data, url):
+    """
+    Sends one prepared batch to Lusha, retrying on rate limits and network errors.
+
+    Args:
+        session (aiohttp.ClientSession): Shared session holding the connection pool and the Lusha headers.
+        request_body (dict): The JSON body with the "companies" list.
+        id_to_pandas_index_map (dict): Maps the Lusha request id back to the pandas index.
+        companies_batch_data (tuple): The original (client_ids, company_names, pandas_indices) arrays.
+        url (str): The Lusha batch API endpoint URL.
+
+    Returns:
+        BatchResult: The found domains (or the error) and the quota headers of the last response.
+    """
+    batch_result = BatchResult()
+    # Serialize once; retries resend the same bytes.
+    body = orjson.dumps(request_body)
+
+    for attempt in range(MAX_RETRIES):
+        delay = lusha_token_bucket.acquire(len(request_body['companies']))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        try:
+            async with session.post(url, data=body, timeout=LUSHA_REQUEST_TIMEOUT) as response:
+
+                # --- Extract rate limit headers ---
+                try:
+                    batch_result.daily_limit = int(response.headers.get('x-rate-limit-daily'))
+                except (TypeError, ValueError):
+                    pass
+                try:
+                    batch_result.daily_left = int(response.headers.get('x-daily-requests-left'))
+                except (TypeError, ValueError):
+                    pass
+                retry_after = response.headers.get('Retry-After')
+                # --- End rate limit header extraction ---
+
+                if response.status in [200, 201]:
+                    try:
+                        data = orjson.loads(await response.read())
+                    except orjson.JSONDecodeError as e:
+                        print(f"  > CRITICAL JSON ERROR: Could not decode JSON from response: {e}")
+                        print(f"  > Full Response Text (for debugging): {await response.text()}")
+                        return batch_result.fail("JSON_DECODE_ERROR")
+
+                    results = batch_result.results
+                    if data:
+                        for returned_lusha_id, company_data_from_lusha in data.items():
+                            original_pandas_index = id_to_pandas_index_map.get(returned_lusha_id)
+                            if original_pandas_index is not None:
+                                results[original_pandas_index] = parse_company_domain(company_data_from_lusha)
+                            else:
+                                print(f"  > Warning: Lusha returned an ID '{returned_lusha_id}' not found in our original batch map.")
+                    else:
+                        print(f"  > Warning: Lusha returned an empty data object for a {response.status} response.")
+                        for pandas_index in companies_batch_data[2]:
+                            results[pandas_index] = "API_RESPONSE_EMPTY_DATA"
+
+                    return batch_result
+
+                elif response.status == 401:
+                    print(f"  > Unauthorized (401). Check your Lusha API key. Critical error, exiting batch processing.")
+                    return batch_result.fail("AUTH_ERROR")
+
+                elif response.status != 429: # Catch any other non-success status codes, like 403
+                    response_text = await response.text()
+                    print(f"  > API error for batch: Status {response.status}, Response: {response_text}")
+                    
+                    if "Lusha FireWall" in response_text:
+                        print("  > Lusha FireWall blocked access. This is likely due to rate limits or account restrictions.")
+                        return batch_result.fail("LUSHA_FIREWALL_BLOCK")
+                    return batch_result.fail(f"API_ERROR_STATUS_{response.status}")
+
+            # Only a 429 reaches this point; the response is released before waiting.
+            batch_result.throttled = True
+            lusha_token_bucket.penalize()
+            if attempt == MAX_RETRIES - 1:
+                print(f"  > Rate limit hit (Attempt {attempt + 1}/{MAX_RETRIES}).")
+                break
+            sleep_for = retry_delay(attempt, retry_after)
+            print(f"  > Rate limit hit. Retrying in {sleep_for:.1f} seconds (Attempt {attempt + 1}/{MAX_RETRIES})...")
+            await asyncio.sleep(sleep_for)
+
+        except asyncio.TimeoutError:
+            batch_result.throttled = True
+            print(f"  > Request timed out for batch (Attempt {attempt + 1}/{MAX_RETRIES}).")
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(retry_delay(attempt))
+        except aiohttp.ClientError as e:
+            print(f"  > Network or request error for batch: {e} (Attempt {attempt + 1}/{MAX_RETRIES}).")
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(retry_delay(attempt))
         except Exception as e:
             print(f"  > An unexpected error occurred for batch: {e}")
-            return {"error": "UNKNOWN_ERROR"}
+            return batch_result.fail("UNKNOWN_ERROR")
 
     print(f"  > Failed to get domains for batch after {MAX_RETRIES} attempts.")
-    return {"error": "Failed After Retries"}
+    return batch_result.fail("Failed After Retries")
 
-# --- Step 3: Loop through companies in batches and process ---
-companies_to_process_batch = []
-for index, row in df.iterrows():
-    company_name = row[COMPANY_NAME_COLUMN]
-    existing_domain = row[DOMAIN_COLUMN]
-    client_company_id = row[CLIENT_COMPANY_ID_COLUMN]
 
-    # Stop if daily requests are exhausted
-    if isinstance(lusha_daily_requests_left, int) and lusha_daily_requests_left <= 0:
-        print(f"\nDAILY LUSHA API QUOTA EXHAUSTED (0 requests left). Stopping script gracefully.")
-        break # Exit the loop, will save processed data
+def prepare_chunk(df):
+    """
+    Fills cached domains into a chunk and picks the companies that still need a lookup.
 
-    if (not existing_domain or str(existing_domain).strip() == '') and \
-       (company_name and str(company_name).strip() != ''):
-        companies_to_process_batch.append((client_company_id, company_name, index))
+    Adds the temporary '_key' column (the normalized company name) to `df`.
 
-    if len(companies_to_process_batch) >= BATCH_SIZE or \
-       (index == len(df) - 1 and len(companies_to_process_batch) > 0):
+    Args:
+        df (pd.DataFrame): One chunk of the input CSV, with DOMAIN_COLUMN already present.
 
-        batch_results = get_domains_from_lusha_batch(companies_to_process_batch, LUSHA_API_KEY, LUSHA_BATCH_ENRICHMENT_URL)
+    Returns:
+        tuple: (todo_ids, todo_names, todo_idx, rows_by_representative). The first three
+               are aligned arrays with one entry per unique company name to send;
+               `rows_by_representative` maps each sent pandas index to every row sharing its name.
+    """
+    # --- Step 3: Fill domains already known from earlier runs ---
+    df['_key'] = df[COMPANY_NAME_COLUMN].fillna('').astype(str).str.lower().str.strip()
+
+    if not args.rebuild:
+        missing_domain_mask = df[DOMAIN_COLUMN].str.strip().eq('') & df['_key'].ne('')
+        cached_domains = load_cached_domains(df.loc[missing_domain_mask, '_key'].unique().tolist())
+        if cached_domains:
+            cache_hits = df.loc[missing_domain_mask, '_key'].map(cached_domains).dropna()
+            df.loc[cache_hits.index, DOMAIN_COLUMN] = cache_hits.values
+            print(f"  > Filled {len(cache_hits)} companies from the local cache ({CACHE_DB_FILE}).")
+
+    # --- Step 4: Collect the companies that need a domain ---
+    # Rows qualify when the domain is blank and both the company name and Client ID are present.
+    # All validation happens here, so every company that reaches a batch can be sent as is.
+    stripped_ids = df[CLIENT_COMPANY_ID_COLUMN].astype(str).str.strip()
+    stripped_names = df[COMPANY_NAME_COLUMN].fillna('').astype(str).str.strip()
+    mask = df[DOMAIN_COLUMN].str.strip().eq('') & \
+           stripped_names.ne('') & \
+           df[CLIENT_COMPANY_ID_COLUMN].notna() & \
+           stripped_ids.ne('')
+
+    # Duplicate company names are looked up once; the first row of each name represents the group.
+    groups = df.loc[mask].groupby('_key').groups
+    representatives = df.loc[mask].drop_duplicates('_key')
+    rows_by_representative = {idx: groups[key] for idx, key in representatives['_key'].items()}
+    print(f"  > {mask.sum()} companies need a domain ({len(representatives)} unique names).")
+
+    # Keep the batch fields as three aligned arrays; a batch is a slice of each.
+    todo_ids = stripped_ids[representatives.index].values
+    todo_names = stripped_names[representatives.index].values
+    todo_idx = representatives.index.values
+    return todo_ids, todo_names, todo_idx, rows_by_representative
+
+
+def write_batch_results(df, rows_by_representative, companies_batch_data, batch_result):
+    """
+    Writes the domains of one batch (or its error message) back into the chunk.
+
+    Each sent company stands for every row sharing its normalized name, so the
+    result is copied to all of those rows.
+
+    Args:
+        df (pd.DataFrame): The chunk the batch was taken from.
+        rows_by_representative (dict): Maps each sent pandas index to all rows sharing its name.
+        companies_batch_data (tuple): Aligned arrays (client_ids, company_names, pandas_indices) for the batch.
+        batch_result (BatchResult): The finished batch; `results` maps pandas_index to found domain.
+    """
+    if batch_result.error is not None:
+        error_indices = [idx for original_pandas_idx in companies_batch_data[2] for idx in rows_by_representative[original_pandas_idx]]
+        df.loc[error_indices, DOMAIN_COLUMN] = batch_result.error
+    elif batch_result.results:
+        idx_list = []
+        dom_list = []
+        for original_pandas_idx, domain_found in batch_result.results.items():
+            matching_rows = rows_by_representative[original_pandas_idx]
+            idx_list.extend(matching_rows)
+            dom_list.extend([domain_found] * len(matching_rows))
+        df.loc[idx_list, DOMAIN_COLUMN] = dom_list
+
+
+async def send_batches(session, df, todo_ids, todo_names, todo_idx, rows_by_representative):
+    """
+    Sends the companies of one chunk to Lusha in concurrent batches.
+
+    MAX_CONCURRENT_BATCHES workers each take the next slice of the arrays, sized
+    by `lusha_batch_size` at the moment it is taken, until every company was sent
+    or the quota says to stop. Results are written back as each batch finishes,
+    always from this coroutine, never from inside the workers.
+
+    Args:
+        session (aiohttp.ClientSession): Shared session holding the connection pool and the Lusha headers.
+        df (pd.DataFrame): The chunk the companies come from.
+        todo_ids (array): Validated, stripped Client IDs of the companies to look up.
+        todo_names (array): Validated, stripped company names, aligned with `todo_ids`.
+        todo_idx (array): The pandas index of each company, aligned with `todo_ids`.
+        rows_by_representative (dict): Maps each sent pandas index to all rows sharing its name.
+    """
+    finished_queue = asyncio.Queue()
+    next_start = 0
+
+    def take_next_batch():
+        nonlocal next_start
+        start = next_start
+        next_start += lusha_batch_size.size
+        return todo_ids[start:next_start], todo_names[start:next_start], todo_idx[start:next_start]
+
+    async def worker():
+        while next_start < len(todo_idx) and not lusha_quota.should_stop():
+            companies_batch_data = take_next_batch()
+            batch_result = await get_domains_from_lusha_batch(session, companies_batch_data, LUSHA_BATCH_ENRICHMENT_URL)
+            await finished_queue.put((companies_batch_data, batch_result))
+
+    async def run_workers():
+        try:
+            await asyncio.gather(*(worker() for _ in range(MAX_CONCURRENT_BATCHES)))
+        finally:
+            await finished_queue.put(None)
+
+    workers = asyncio.create_task(run_workers())
+    while (finished := await finished_queue.get()) is not None:
+        companies_batch_data, batch_result = finished
+        write_batch_results(df, rows_by_representative, companies_batch_data, batch_result)
+
+    await workers  # Re-raises anything that went wrong inside a worker.
+
+
+def create_lusha_session():
+    """
+    Creates the aiohttp session used for every batch of the run.
+
+    Connections to Lusha are kept alive and reused across batches, DNS answers
+    are cached for DNS_CACHE_TTL_SECONDS, and the request headers are set once
+    on the session. Must be called from inside the running event loop.
+    """
+    headers = {
+        'api_key': LUSHA_API_KEY, 
+        'Content-Type': 'application/json',
+        'Accept': 'application/json'
+    }
+    resolver = aiohttp.AsyncResolver() if aiodns is not None else aiohttp.DefaultResolver()
+    connector = aiohttp.TCPConnector(limit=CONNECTION_POOL_LIMIT,
+                                     limit_per_host=CONNECTION_POOL_LIMIT,
+                                     keepalive_timeout=CONNECTION_KEEPALIVE_SECONDS,
+                                     resolver=resolver,
+                                     ttl_dns_cache=DNS_CACHE_TTL_SECONDS)
+    return aiohttp.ClientSession(connector=connector, headers=headers)
+
+
+def load_checkpoint():
+    """
+    Reads how far an earlier, interrupted run got.
 
-        if "error" in batch_results:
-            error_message = batch_results['error']
-            print(f"  > Critical error encountered in batch: {error_message}. Stopping script.")
-            print(f"  > Current Lusha Daily Limit: {lusha_daily_limit}, Requests Left: {lusha_daily_requests_left}")
+    Returns:
+        tuple: (rows_done, output_bytes) - input rows already written to OUTPUT_CSV_FILE
+               and the size of that file at that point. (0, 0) when there is nothing to resume.
+    """
+    if not os.path.exists(CHECKPOINT_FILE) or not os.path.exists(OUTPUT_CSV_FILE):
+        return 0, 0
+    with open(CHECKPOINT_FILE) as checkpoint_file:
+        rows_done, output_bytes = (int(value) for value in checkpoint_file.read().split())
+    return rows_done, output_bytes
 
-            for _, _, original_pandas_idx in companies_to_process_batch:
-                df.loc[original_pandas_idx, DOMAIN_COLUMN] = error_message
-            df.to_csv(OUTPUT_CSV_FILE, index=False)
-            exit() # Exit the script on critical errors
 
-        for original_pandas_index, domain_found in batch_results.items():
-            df.loc[original_pandas_index, DOMAIN_COLUMN] = domain_found
+def save_checkpoint(rows_done):
+    """Records that the first `rows_done` input rows are final in OUTPUT_CSV_FILE."""
+    with open(CHECKPOINT_FILE, 'w') as checkpoint_file:
+        checkpoint_file.write(f"{rows_done} {os.path.getsize(OUTPUT_CSV_FILE)}")
 
-        companies_to_process_batch = []
-        print(f"  > Pausing for {REQUEST_DELAY_SECONDS} seconds...")
-        print(f"  > Current Lusha Daily Limit: {lusha_daily_limit}, Requests Left: {lusha_daily_requests_left}")
-        time.sleep(REQUEST_DELAY_SECONDS)
 
-# --- Step 4: Save the updated DataFrame to a new CSV file ---
-df.to_csv(OUTPUT_CSV_FILE, index=False)
+async def process_csv():
+    """
+    Streams the input CSV in chunks of CSV_CHUNK_SIZE rows, looks up the missing
+    domains of each chunk and appends the finished chunk to OUTPUT_CSV_FILE.
+
+    Memory stays bounded by the chunk size, and a checkpoint is saved after every
+    chunk so an interrupted run resumes where it stopped. Once the quota says to
+    stop, the remaining rows are copied through unchanged so the output is always
+    complete; they are not checkpointed, so the next run looks them up.
+    """
+    rows_done, output_bytes = load_checkpoint()
+    if rows_done:
+        print(f"Resuming after {rows_done} rows from checkpoint '{CHECKPOINT_FILE}'. Delete it to start over.")
+        with open(OUTPUT_CSV_FILE, 'r+b') as output_file:
+            output_file.truncate(output_bytes)
+
+    write_header = rows_done == 0
+    rows_seen = 0
+    async with create_lusha_session() as session:
+        for df in pd.read_csv(INPUT_CSV_FILE, chunksize=CSV_CHUNK_SIZE, dtype=lookup_dtypes):
+            chunk_start = rows_seen
+            rows_seen += len(df)
+            if rows_seen <= rows_done:
+                continue
+            if chunk_start < rows_done:
+                df = df.iloc[rows_done - chunk_start:].copy()
+
+            # Every chunk gets the domain column, including chunks copied through after a stop,
+            # so all rows match the header the first chunk wrote.
+            if DOMAIN_COLUMN not in df.columns:
+                df[DOMAIN_COLUMN] = ''
+            df[DOMAIN_COLUMN] = df[DOMAIN_COLUMN].fillna('').astype('string')
+
+            if not lusha_quota.should_stop():
+                print(f"\nProcessing rows {max(chunk_start, rows_done) + 1}-{rows_seen}...")
+                todo_ids, todo_names, todo_idx, rows_by_representative = prepare_chunk(df)
+
+                # --- Step 5: Send the batches to Lusha and write the results back ---
+                await send_batches(session, df, todo_ids, todo_names, todo_idx, rows_by_representative)
+                df = df.drop(columns='_key')
+
+            # --- Step 6: Append the finished chunk to the output CSV ---
+            df.to_csv(OUTPUT_CSV_FILE, mode='w' if write_header else 'a', header=write_header, index=False)
+            write_header = False
+            if not lusha_quota.should_stop():
+                save_checkpoint(rows_seen)
+
+
+# Resolve the Lusha host once up front so the first connections don't wait on DNS.
+try:
+    socket.getaddrinfo(urlparse(LUSHA_BATCH_ENRICHMENT_URL).hostname, 443)
+except socket.gaierror as e:
+    print(f"WARNING: Could not resolve the Lusha API host: {e}")
+
+asyncio.run(process_csv())
+
+if lusha_quota.exhausted():
+    print(f"\nDAILY LUSHA API QUOTA EXHAUSTED (0 requests left). Remaining companies were skipped.")
+    if os.path.exists(CHECKPOINT_FILE):
+        print(f"  > Progress saved to '{CHECKPOINT_FILE}'; the next run resumes from there.")
+    else:
+        print(f"  > No chunk was completed, so the next run starts over; the local cache fills in the domains already found.")
+
+if lusha_quota.critical_error is not None:
+    print(f"  > Critical error encountered in batch: {lusha_quota.critical_error}. Stopping script.")
+    print(f"  > Current Lusha Daily Limit: {lusha_quota.daily_limit}, Requests Left: {lusha_quota.daily_left}")
+    exit() # Exit the script on critical errors
+
+if os.path.exists(CHECKPOINT_FILE) and not lusha_quota.exhausted():
+    os.remove(CHECKPOINT_FILE)
 print(f"\nFinished processing. Results saved to: {OUTPUT_CSV_FILE}")
-print(f"Final Lusha Daily Limit: {lusha_daily_limit}, Requests Left: {lusha_daily_requests_left}")
+print(f"Final Lusha Daily Limit: {lusha_quota.daily_limit}, Requests Left: {lusha_quota.daily_left}")